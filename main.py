@@ -1,14 +1,36 @@
 import os
-from fastapi import FastAPI, HTTPException
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import orjson
+import uvicorn
+from fastapi import FastAPI, HTTPException, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Optional
 from bson import ObjectId
 
-from database import db, create_document, get_documents
-from schemas import Product, Cart, CartItem
+from database import db, create_document, ensure_indexes
+from schemas import Product
 
-app = FastAPI(title="Sportswear Shop API")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Build indexes in the background so startup never waits on server selection
+    index_task = asyncio.create_task(ensure_indexes())
+    yield
+    index_task.cancel()
+
+
+app = FastAPI(
+    title="Sportswear Shop API",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -18,6 +40,8 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(GZipMiddleware, minimum_size=500, compresslevel=4)
+
 # Utility to convert Mongo ObjectIds to strings
 
 def serialize_document(doc):
@@ -31,71 +55,176 @@ def serialize_document(doc):
     return doc
 
 
+def _oid(value):
+    """Parse an ObjectId, answering 400 for malformed ids"""
+    if not ObjectId.is_valid(value):
+        raise HTTPException(status_code=400, detail="ID inválido")
+    return ObjectId(value)
+
+
+# Per-category cache of the serialized product list: category -> (expiry, body, etag)
+
+PRODUCT_CACHE_TTL = 30
+_PRODUCT_CACHE_MAX_KEYS = 256
+_PRODUCT_CACHE = {}
+# In-flight refills: category -> task shared by every request that misses that key
+_PRODUCT_REFILLS = {}
+# Bumped on invalidation so a list read before a write is not cached after it
+_PRODUCT_CACHE_GEN = 0
+
+
+def invalidate_product_cache():
+    global _PRODUCT_CACHE_GEN
+    _PRODUCT_CACHE_GEN += 1
+    _PRODUCT_CACHE.clear()
+    _PRODUCT_REFILLS.clear()
+
+
+async def _refill_product_list(category):
+    """Query and serialize one category's product list, caching the result"""
+    gen = _PRODUCT_CACHE_GEN
+    try:
+        if db is None:
+            raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+        filter_q = {"category": category} if category else {}
+        # Shape documents server-side: _id -> id string
+        pipeline = [
+            {"$match": filter_q},
+            {"$addFields": {"id": {"$toString": "$_id"}}},
+            {"$project": {"_id": 0}},
+        ]
+        products = [p async for p in db["product"].aggregate(pipeline)]
+        body = orjson.dumps(products)
+        # Weak: GZipMiddleware may serve these bytes gzip- or identity-coded under the same tag
+        etag = 'W/"%s"' % hashlib.sha1(body).hexdigest()
+        entry = (time.monotonic() + PRODUCT_CACHE_TTL, body, etag)
+        if gen == _PRODUCT_CACHE_GEN:
+            if len(_PRODUCT_CACHE) >= _PRODUCT_CACHE_MAX_KEYS:
+                _PRODUCT_CACHE.clear()
+            _PRODUCT_CACHE[category] = entry
+        return entry
+    finally:
+        if _PRODUCT_REFILLS.get(category) is asyncio.current_task():
+            del _PRODUCT_REFILLS[category]
+
+
+async def get_product_list(category):
+    """Return the cached (expiry, body, etag) entry, refilling it at most once per key"""
+    entry = _PRODUCT_CACHE.get(category)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry
+
+    task = _PRODUCT_REFILLS.get(category)
+    if task is None:
+        task = asyncio.create_task(_refill_product_list(category))
+        _PRODUCT_REFILLS[category] = task
+    # Shielded so one disconnecting client does not cancel the refill for the others
+    return await asyncio.shield(task)
+
+
+def _etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+# LRU of the product fields snapshotted into carts: product ObjectId -> (expiry, doc)
+
+PRODUCT_SNAPSHOT_TTL = 60
+_PRODUCT_SNAPSHOT_MAX = 1024
+_PRODUCT_SNAPSHOTS = OrderedDict()
+
+
+async def get_product_snapshot(product_oid):
+    """Return price/title/image_url for a product, hitting Mongo only on a miss"""
+    entry = _PRODUCT_SNAPSHOTS.get(product_oid)
+    if entry is not None and entry[0] > time.monotonic():
+        _PRODUCT_SNAPSHOTS.move_to_end(product_oid)
+        return entry[1]
+
+    prod = await db["product"].find_one(
+        {"_id": product_oid},
+        projection={"price": 1, "title": 1, "image_url": 1},
+    )
+    if prod is not None:
+        _PRODUCT_SNAPSHOTS[product_oid] = (time.monotonic() + PRODUCT_SNAPSHOT_TTL, prod)
+        _PRODUCT_SNAPSHOTS.move_to_end(product_oid)
+        if len(_PRODUCT_SNAPSHOTS) > _PRODUCT_SNAPSHOT_MAX:
+            _PRODUCT_SNAPSHOTS.popitem(last=False)
+    return prod
+
+
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Sportswear Shop Backend Running"}
 
 
 # ---------------------- Products ----------------------
 
-@app.post("/api/products", response_model=dict)
-def create_product(product: Product):
+@app.post("/api/products", response_model=None)
+async def create_product(product: Product):
     try:
-        new_id = create_document("product", product)
+        new_id = await create_document("product", product)
+        invalidate_product_cache()
         return {"id": new_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/api/products", response_model=List[dict])
-def list_products(category: Optional[str] = None):
+@app.get("/api/products", response_model=None)
+async def list_products(category: Optional[str] = None, if_none_match: Optional[str] = Header(None)):
     try:
-        filter_q = {"category": category} if category else {}
-        products = get_documents("product", filter_q)
-        return [serialize_document(p) for p in products]
+        _, body, etag = await get_product_list(category)
+        headers = {"ETag": etag, "Cache-Control": f"public, max-age={PRODUCT_CACHE_TTL}"}
+        if _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/api/products/seed", response_model=dict)
-def seed_products():
+_DEMO_PRODUCTS = [
+    {
+        "title": "Camiseta Running Pro",
+        "description": "Tejido respirable y de secado rápido.",
+        "price": 24.99,
+        "category": "Ropa",
+        "in_stock": True,
+        "image_url": "https://images.unsplash.com/photo-1542291026-7eec264c27ff?w=800&q=80",
+        "sizes": ["S", "M", "L", "XL"],
+    },
+    {
+        "title": "Zapatillas Training X",
+        "description": "Estabilidad y agarre para el gym.",
+        "price": 79.99,
+        "category": "Calzado",
+        "in_stock": True,
+        "image_url": "https://images.unsplash.com/photo-1542291026-7d3b7318f19b?w=800&q=80",
+        "sizes": ["38", "39", "40", "41", "42", "43"],
+    },
+    {
+        "title": "Mochila Deportiva",
+        "description": "Compartimentos múltiples y resistente al agua.",
+        "price": 39.99,
+        "category": "Accesorios",
+        "in_stock": True,
+        "image_url": "https://images.unsplash.com/photo-1520975922313-b46f52b85072?w=800&q=80",
+        "sizes": None,
+    },
+]
+
+
+@app.post("/api/products/seed", response_model=None)
+async def seed_products():
     """Create a small set of demo products if the collection is empty"""
     try:
-        count = db["product"].count_documents({})
-        if count > 0:
+        if await db["product"].estimated_document_count() > 0:
             return {"created": 0, "message": "Products already exist"}
-        demo_products = [
-            {
-                "title": "Camiseta Running Pro",
-                "description": "Tejido respirable y de secado rápido.",
-                "price": 24.99,
-                "category": "Ropa",
-                "in_stock": True,
-                "image_url": "https://images.unsplash.com/photo-1542291026-7eec264c27ff?w=800&q=80",
-                "sizes": ["S", "M", "L", "XL"],
-            },
-            {
-                "title": "Zapatillas Training X",
-                "description": "Estabilidad y agarre para el gym.",
-                "price": 79.99,
-                "category": "Calzado",
-                "in_stock": True,
-                "image_url": "https://images.unsplash.com/photo-1542291026-7d3b7318f19b?w=800&q=80",
-                "sizes": ["38", "39", "40", "41", "42", "43"],
-            },
-            {
-                "title": "Mochila Deportiva",
-                "description": "Compartimentos múltiples y resistente al agua.",
-                "price": 39.99,
-                "category": "Accesorios",
-                "in_stock": True,
-                "image_url": "https://images.unsplash.com/photo-1520975922313-b46f52b85072?w=800&q=80",
-                "sizes": None,
-            },
-        ]
-        for p in demo_products:
-            db["product"].insert_one(p)
-        return {"created": len(demo_products)}
+        # insert_many sets _id on the dicts it is given, so insert copies
+        await db["product"].insert_many([dict(p) for p in _DEMO_PRODUCTS], ordered=False)
+        invalidate_product_cache()
+        return {"created": len(_DEMO_PRODUCTS)}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -122,43 +251,50 @@ class QtyPayload(BaseModel):
     quantity: int = 1
 
 
-@app.post("/api/cart:add", response_model=dict)
-def add_to_cart(payload: AddToCartPayload):
+@app.post("/api/cart:add", response_model=None)
+async def add_to_cart(payload: AddToCartPayload):
+    product_oid = _oid(payload.product_id)
+    cart_oid = _oid(payload.cart_id) if payload.cart_id else None
     try:
         # Fetch product to snapshot fields
-        prod = db["product"].find_one({"_id": ObjectId(payload.product_id)})
+        prod = await get_product_snapshot(product_oid)
         if not prod:
             raise HTTPException(status_code=404, detail="Producto no encontrado")
 
-        item = CartItem(
-            product_id=str(prod["_id"]),
-            quantity=max(1, payload.quantity or 1),
-            size=payload.size,
-            unit_price=float(prod.get("price", 0)),
-            title=prod.get("title", "Producto"),
-            image_url=prod.get("image_url"),
-        )
+        # Built from known-typed values, so it is stored without a CartItem round-trip
+        item = {
+            "product_id": str(prod["_id"]),
+            "quantity": max(1, payload.quantity or 1),
+            "size": payload.size,
+            "unit_price": float(prod.get("price", 0)),
+            "title": prod.get("title", "Producto"),
+            "image_url": prod.get("image_url"),
+        }
 
         # Create or update cart
-        if payload.cart_id:
-            cart = db["cart"].find_one({"_id": ObjectId(payload.cart_id)})
-            if not cart:
+        if cart_oid is not None:
+            match = {"product_id": item["product_id"], "size": item["size"]}
+            # If same product+size exists, increase quantity in place
+            res = await db["cart"].update_one(
+                {"_id": cart_oid, "items": {"$elemMatch": match}},
+                {"$inc": {"items.$.quantity": item["quantity"]}},
+            )
+            if res.matched_count == 0:
+                # Otherwise append it, guarding against a concurrent add of the same line
+                res = await db["cart"].update_one(
+                    {"_id": cart_oid, "items": {"$not": {"$elemMatch": match}}},
+                    {"$push": {"items": item}},
+                )
+            if res.matched_count == 0:
+                res = await db["cart"].update_one(
+                    {"_id": cart_oid, "items": {"$elemMatch": match}},
+                    {"$inc": {"items.$.quantity": item["quantity"]}},
+                )
+            if res.matched_count == 0:
                 raise HTTPException(status_code=404, detail="Carro no encontrado")
-            items = cart.get("items", [])
-            # If same product+size exists, increase quantity
-            merged = False
-            for it in items:
-                if it.get("product_id") == item.product_id and it.get("size") == item.size:
-                    it["quantity"] = int(it.get("quantity", 1)) + item.quantity
-                    merged = True
-                    break
-            if not merged:
-                items.append(item.model_dump())
-            db["cart"].update_one({"_id": cart["_id"]}, {"$set": {"items": items}})
-            return {"cart_id": str(cart["_id"]) }
+            return {"cart_id": payload.cart_id}
         else:
-            cart_model = Cart(items=[item])
-            new_id = create_document("cart", cart_model)
+            new_id = await create_document("cart", {"items": [item], "checked_out": False})
             return {"cart_id": new_id}
     except HTTPException:
         raise
@@ -166,29 +302,31 @@ def add_to_cart(payload: AddToCartPayload):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/api/cart", response_model=dict)
-def get_cart(cart_id: str):
+@app.get("/api/cart", response_model=None)
+async def get_cart(cart_id: str):
+    cart_oid = _oid(cart_id)
     try:
-        cart = db["cart"].find_one({"_id": ObjectId(cart_id)})
+        cart = await db["cart"].find_one({"_id": cart_oid})
         if not cart:
             raise HTTPException(status_code=404, detail="Carro no encontrado")
         cart_ser = serialize_document(cart)
-        return cart_ser
+        return ORJSONResponse(content=cart_ser)
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/api/cart:remove", response_model=dict)
-def remove_from_cart(payload: RemovePayload):
+@app.post("/api/cart:remove", response_model=None)
+async def remove_from_cart(payload: RemovePayload):
+    cart_oid = _oid(payload.cart_id)
     try:
-        cart = db["cart"].find_one({"_id": ObjectId(payload.cart_id)})
-        if not cart:
+        res = await db["cart"].update_one(
+            {"_id": cart_oid},
+            {"$pull": {"items": {"product_id": payload.product_id, "size": payload.size}}},
+        )
+        if res.matched_count == 0:
             raise HTTPException(status_code=404, detail="Carro no encontrado")
-        items = cart.get("items", [])
-        items = [i for i in items if not (i.get("product_id") == payload.product_id and i.get("size") == payload.size)]
-        db["cart"].update_one({"_id": cart["_id"]}, {"$set": {"items": items}})
         return {"cart_id": payload.cart_id}
     except HTTPException:
         raise
@@ -196,18 +334,17 @@ def remove_from_cart(payload: RemovePayload):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/api/cart:qty", response_model=dict)
-def update_quantity(payload: QtyPayload):
+@app.post("/api/cart:qty", response_model=None)
+async def update_quantity(payload: QtyPayload):
+    cart_oid = _oid(payload.cart_id)
     try:
-        cart = db["cart"].find_one({"_id": ObjectId(payload.cart_id)})
-        if not cart:
+        res = await db["cart"].update_one(
+            {"_id": cart_oid},
+            {"$set": {"items.$[elem].quantity": max(1, int(payload.quantity))}},
+            array_filters=[{"elem.product_id": payload.product_id, "elem.size": payload.size}],
+        )
+        if res.matched_count == 0:
             raise HTTPException(status_code=404, detail="Carro no encontrado")
-        items = cart.get("items", [])
-        for it in items:
-            if it.get("product_id") == payload.product_id and it.get("size") == payload.size:
-                it["quantity"] = max(1, int(payload.quantity))
-                break
-        db["cart"].update_one({"_id": cart["_id"]}, {"$set": {"items": items}})
         return {"cart_id": payload.cart_id}
     except HTTPException:
         raise
@@ -215,8 +352,21 @@ def update_quantity(payload: QtyPayload):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+_DB_URL_SET = bool(os.getenv("DATABASE_URL"))
+_DB_NAME_SET = bool(os.getenv("DATABASE_NAME"))
+
+# Healthy diagnostics are recomputed at most once per HEALTH_CACHE_TTL seconds
+
+HEALTH_CACHE_TTL = 30
+_HEALTH_CACHE = {"exp": 0, "data": None}
+
+
 @app.get("/test")
-def test_database():
+async def test_database():
+    now = time.monotonic()
+    if _HEALTH_CACHE["data"] is not None and now < _HEALTH_CACHE["exp"]:
+        return _HEALTH_CACHE["data"]
+
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -233,7 +383,7 @@ def test_database():
             response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = await db.list_collection_names()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -243,14 +393,16 @@ def test_database():
     except Exception as e:
         response["database"] = f"❌ Error: {str(e)[:50]}"
 
-    import os
-    response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
-    response["database_name"] = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
+    response["database_url"] = "✅ Set" if _DB_URL_SET else "❌ Not Set"
+    response["database_name"] = "✅ Set" if _DB_NAME_SET else "❌ Not Set"
 
+    # Only a healthy result is cached, so a recovery shows up on the next probe
+    if response["database"] == "✅ Connected & Working":
+        _HEALTH_CACHE["exp"] = now + HEALTH_CACHE_TTL
+        _HEALTH_CACHE["data"] = response
     return response
 
 
 if __name__ == "__main__":
-    import uvicorn
     port = int(os.getenv("PORT", 8000))
     uvicorn.run(app, host="0.0.0.0", port=port)